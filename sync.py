@@ -6,7 +6,7 @@
 #
 # Prerequisites/Instructions:
 # 1. Python3
-# 2. pip install mendeley dotenv
+# 2. pip install mendeley dotenv aiohttp orjson (and optionally uvloop)
 # 3. Auth token for mendeley. This requires registering a oauth app 
 #    with mendeley and acquiring an auth token, and saving all this 
 #    info in .mendeley_config file in current dir or user home.
@@ -44,20 +44,24 @@ from pprint import pprint
 import shutil
 import logging
 import os
-import http
-import http.server
 import webbrowser
 import base64
 from urllib import parse
-import json
-import subprocess
-import uuid
+import asyncio
+import tempfile
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 from mendeley import Mendeley, MendeleyAuthorizationCodeAuthenticator
 from mendeley.session import MendeleySession
 from mendeley.auth import MendeleyAuthorizationCodeTokenRefresher
 from mendeley.exception import MendeleyApiException, MendeleyException
+from mendeley.models.documents import UserDocument
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+import aiohttp
+from aiohttp import web
+import orjson
 
 
 # Constants
@@ -90,39 +94,76 @@ Please follow messages in the terminal to save your token.
 '''.encode()
 
 
-class RH(http.server.BaseHTTPRequestHandler):
-    def do_GET(self):
-        query = parse.parse_qs(parse.urlparse(self.path).query)
-        auth = mendeley_client.start_authorization_code_flow(query['state'][0])
-        mendeley_session = auth.authenticate(f'{mendeley_client.redirect_uri}{self.path}')
-        mendeley_token = json.dumps(mendeley_session.token)
-        mendeley_token_b64 = base64.b64encode(mendeley_token.encode()).decode()
-        self.send_response(http.HTTPStatus.OK)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(callback_html)
-        print('Login succeeded.')
-        print('Please set an environment variable MENDELEY_OAUTH2_TOKEN_BASE64 or add it to a config file:')
-        print()
-        print(f'MENDELEY_OAUTH2_TOKEN_BASE64={mendeley_token_b64}')
-        print()
-
-def get_token():
+# How long to wait for the login to go through in the browser (in seconds)
+LOGIN_TIMEOUT = 300
+
+async def get_token():
     """Login and get token"""
     # webbrowser.open(mendeley_client.start_authorization_code_flow().get_login_url())
     print("Open below URL in browser:")
     print(mendeley_client.start_authorization_code_flow().get_login_url())
     netloc = parse.urlparse(mendeley_client.redirect_uri)
-    http.server.HTTPServer((netloc.hostname, netloc.port), RH).handle_request()
-
+    loop = asyncio.get_running_loop()
+    token = loop.create_future()
+
+    async def callback(request):
+        # only the redirect with the auth code is of interest; browsers may send other 
+        # requests too: those to other paths (e.g., for favicon) get a 404 from the router 
+        # and those to the redirect path without an auth code get a 400 here
+        if "state" not in request.query:
+            raise web.HTTPBadRequest()
+        auth = mendeley_client.start_authorization_code_flow(request.query["state"])
+        try:
+            mendeley_session = await loop.run_in_executor(None, auth.authenticate, 
+                                        f'{mendeley_client.redirect_uri}{request.path_qs}')
+        except Exception as ex:
+            if token.done():        # login already went through, nothing to report
+                return web.Response(body=callback_html, content_type='text/html', charset='utf-8')
+            # e.g., a repeated request with an auth code that was already exchanged; 
+            # keep waiting so that another attempt can still go through
+            print("Login attempt failed: {}".format(ex))
+            raise web.HTTPBadRequest(text="Login failed, please try again.")
+        if not token.done():
+            token.set_result(mendeley_session.token)
+        return web.Response(body=callback_html, content_type='text/html', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get(netloc.path or "/", callback)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, netloc.hostname, netloc.port).start()
+        mendeley_token = orjson.dumps(await asyncio.wait_for(token, timeout=LOGIN_TIMEOUT)).decode()
+    finally:
+        await runner.cleanup()
+
+    mendeley_token_b64 = base64.b64encode(mendeley_token.encode()).decode()
+    print('Login succeeded.')
+    print('Please set an environment variable MENDELEY_OAUTH2_TOKEN_BASE64 or add it to a config file:')
+    print()
+    print(f'MENDELEY_OAUTH2_TOKEN_BASE64={mendeley_token_b64}')
+    print()
+
+# Max number of connections kept open to mendeley api
+MENDELEY_MAX_CONNECTIONS = 16
+
+# The session is built once and reused (its token gets refreshed in place as needed). 
+# This script only asks for it once per run; the cache is for a long-running wrapper 
+# that syncs periodically and would otherwise rebuild the session every time.
+@functools.lru_cache(maxsize=1)
 def get_session():
     if mendeley_token_b64 is None:
         raise MendeleyException('Login required. Please `mendeley get token` first.')
     else:
-        mendeley_token = json.loads(base64.b64decode(mendeley_token_b64.encode()).decode())
+        mendeley_token = orjson.loads(base64.b64decode(mendeley_token_b64.encode()))
         auth = MendeleyAuthorizationCodeAuthenticator(mendeley_client, None)
         mendeley_session = MendeleySession(auth.mendeley, token=mendeley_token, client=auth.client,
                                            refresher=MendeleyAuthorizationCodeTokenRefresher(auth))
+        # sdk calls are made from many threads at once; keep enough connections 
+        # around for all of them so they don't have to set up a new one each time
+        adapter = HTTPAdapter(pool_connections=MENDELEY_MAX_CONNECTIONS, 
+                                pool_maxsize=MENDELEY_MAX_CONNECTIONS)
+        mendeley_session.mount("https://", adapter)
     return mendeley_session
 
 
@@ -130,6 +171,33 @@ def get_session():
 # Check limit parameter for apis at https://api.mendeley.com/apidocs/docs
 MENDELEY_PAGINATION_LIMIT = 500
 
+def _bearer(session):
+    return {"Authorization": "Bearer {}".format(session.token["access_token"])}
+
+def open_http(session):
+    """Opens an http session authorized to make raw mendeley api calls on behalf of the 
+    mendeley session. Meant to be shared by all such calls so that connections are reused"""
+    connector = aiohttp.TCPConnector(limit_per_host=MENDELEY_MAX_CONNECTIONS)
+    return aiohttp.ClientSession(headers=_bearer(session), connector=connector)
+
+async def paginate(session, http, uri):
+    """Yields entries from a mendeley list api, following "next" links across pages"""
+    refreshed = False
+    while uri:
+        async with http.get(uri) as rsp:
+            # access token may have expired; refresh it once and retry
+            if rsp.status == 401 and not refreshed:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, session.refresher.refresh, session)
+                http.headers.update(_bearer(session))
+                refreshed = True
+                continue
+            rsp.raise_for_status()
+            # parse the raw body; mendeley responds with its own vendor content types anyway
+            for entry in orjson.loads(await rsp.read()):
+                yield entry
+            uri = str(rsp.links["next"]["url"]) if "next" in rsp.links else None
+
 # Model for mendeley folder
 # mendeley library doesn't provide "folders" natively; need to query using raw api
 class Folder:
@@ -140,99 +208,111 @@ class Folder:
         self.name = name
         self.parent = parent_id
 
-    # Reference: https://api.mendeley.com/apidocs/docs#!/folders/getDocumentsForFolder
-    def documents(self, session):
+    # Reference: https://api.mendeley.com/apidocs/docs#!/documents/getDocuments
+    async def documents(self, session, http):
         """Lists all documents in the folder"""
-        document_ids = []
-        FOLDERS_DOCS_REST_URI = "https://api.mendeley.com/folders/{}/documents?limit={}"
-        uri = FOLDERS_DOCS_REST_URI.format(self.id, MENDELEY_PAGINATION_LIMIT)
-        rsp = session.request("GET", uri)
-        while True:
-            # results may be returned in multiple pages
-            for f in json.loads(rsp.content):
-                document_ids.append(f["id"])
-        
-            # are there more pages to read?
-            if "next" not in rsp.links:
-                break
-            rsp = session.request("GET", rsp.links["next"]["url"])
-
-        # NOTE: If each get() makes a separate API request, it'll be a lot of requests 
-        # if there are a lot of documents in the folder; mendeley may impose api request 
-        # quotas but for now, tens of documents seems to be working fine. We may need to
-        # move to documents.iter() and get them in big batches if we hit this limit.
-        documents = [session.documents.get(id) for id in document_ids]
+        # The documents api can filter by folder and return whole documents, so each 
+        # page brings in up to MENDELEY_PAGINATION_LIMIT documents in one request 
+        # (the folders api only lists ids which would then need a request per document).
+        # Documents are wrapped straight from the json instead of going through the 
+        # sdk's blocking documents api, they still work with the rest of the sdk.
+        DOCS_REST_URI = "https://api.mendeley.com/documents?folder_id={}&view=all&limit={}"
+        uri = DOCS_REST_URI.format(self.id, MENDELEY_PAGINATION_LIMIT)
+        # results may be returned in multiple pages
+        documents = [UserDocument(session, f) async for f in paginate(session, http, uri)]
         return documents
 
     # Reference: https://api.mendeley.com/apidocs/docs#!/folders/getFolders
-    def get_folders(session):
+    async def get_folders(session, http):
         """Lists <id,name> of all the user folders in mendeley"""
         folders = []
         FOLDERS_REST_URI = "https://api.mendeley.com/folders?limit={}"
         uri = FOLDERS_REST_URI.format(MENDELEY_PAGINATION_LIMIT)
-        rsp = session.request("GET", uri)
-        while True:
-            # results may be returned in multiple pages
-            for f in json.loads(rsp.content):
-                parent_id = f["parent_id"] if "parent_id" in f else None
-                folders.append(Folder(f["id"], f["name"], parent_id))
-        
-            # are there more pages to read?
-            if "next" not in rsp.links:
-                break
-            rsp = session.request("GET", rsp.links["next"]["url"])
+        # results may be returned in multiple pages
+        async for f in paginate(session, http, uri):
+            parent_id = f["parent_id"] if "parent_id" in f else None
+            folders.append(Folder(f["id"], f["name"], parent_id))
         return folders
 
 
 # Python wrapper for rmapi
+# Each command spawns a separate rmapi process; cap how many of them talk
+# to the remarkable cloud at the same time
+RMAPI_MAX_CONCURRENCY = 8
+
 class RmApi:
     def __init__(self, exec_path = "./rmapi"):
-        self.path = exec_path
-
-    def _run(self, *args):
+        self.path = os.path.abspath(exec_path)    # rmapi may be run from other dirs
+        self._slots = asyncio.Semaphore(RMAPI_MAX_CONCURRENCY)
+        # commands that change the remote folder go one at a time; rmapi syncs 
+        # its whole tree on every write and concurrent writers may clobber each other
+        self._writes = asyncio.Semaphore(1)
+        self._listings = {}         # cached (subfolders, files) per folder
+
+    async def _run(self, *args, cwd=None):
         args = (self.path, *args)
-        popen = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        ret = popen.wait()
-        output = popen.stdout.read()
-        error = popen.stderr.read()
-        if ret != 0:
+        async with self._slots:
+            proc = await asyncio.create_subprocess_exec(*args, cwd=cwd,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            output, error = await proc.communicate()
+        if proc.returncode != 0:
             raise Exception("RmAPI {} command failed: {}".format(args, error))
         return output
 
-    def subfolders(self, parent=None):
-        out = self._run("ls") if not parent else self._run("ls", parent)
-        # parse entries from rmapi output: this can be very flaky
-        entries = out.decode('utf-8').split("\n")
-        entries = [e.split("\t") for e in entries]
-        return [e[1] for e in entries if e[0] == "[d]"]
-
-    def files(self, parent=None):
-        out = self._run("ls") if not parent else self._run("ls", parent)
+    @staticmethod
+    def _entries(out):
+        """Yields (kind, name) for each entry in rmapi "ls" output"""
         # parse entries from rmapi output: this can be very flaky
-        entries = out.decode('utf-8').split("\n")
-        entries = [e.split("\t") for e in entries]
-        return [e[1] for e in entries if e[0] == "[f]"]
-
-    def download(self, rfolder, rfile, outpath):
+        for line in out.decode('utf-8').splitlines():
+            kind, _, name = line.partition("\t")
+            yield kind, name
+
+    async def _list(self, parent=None):
+        """Lists <parent> folder as (subfolders, files), reusing an earlier listing if it is still valid"""
+        if parent not in self._listings:
+            out = await self._run("ls") if not parent else await self._run("ls", parent)
+            dirs, files = [], []
+            for kind, name in self._entries(out):
+                if kind == "[d]":   dirs.append(name)
+                if kind == "[f]":   files.append(name)
+            self._listings[parent] = (dirs, files)
+        return self._listings[parent]
+
+    async def subfolders(self, parent=None):
+        dirs, _ = await self._list(parent)
+        return dirs
+
+    async def files(self, parent=None):
+        _, files = await self._list(parent)
+        return files
+
+    async def download(self, rfolder, rfile, outpath):
         """Download a single file from remarkable <rfolder/rfile> path exported with annotations"""
         rpath="{}/{}".format(rfolder, rfile)
-        out = self._run("geta", "-a", rpath)
-        localpath = "{}-annotations.pdf".format(rfile)      # the downloaded file format
-        if not os.path.exists(localpath):
-            raise Exception("File not downloaded from remarkable cloud: {}".format(rpath))
-        shutil.move(localpath, outpath)
-        os.remove("{}.zip".format(rfile))
-
-    def upload(self, inpath, rfolder):
+        # rmapi leaves its files (including a zip of the original) in the current 
+        # dir, so run it in a scratch dir that goes away along with whatever's left
+        with tempfile.TemporaryDirectory() as td:
+            out = await self._run("geta", "-a", rpath, cwd=td)
+            localpath = os.path.join(td, "{}-annotations.pdf".format(rfile))      # the downloaded file format
+            if not os.path.exists(localpath):
+                raise Exception("File not downloaded from remarkable cloud: {}".format(rpath))
+            shutil.move(localpath, outpath)
+
+    async def upload(self, inpath, rfolder):
         """Upload a single local file to remarkable <rfolder>"""
-        self._run("put", inpath, rfolder)
+        async with self._writes:
+            await self._run("put", inpath, rfolder)
+        self._listings.pop(rfolder, None)
 
-    def remove(self, rfolder, rfile):
+    async def remove(self, rfolder, rfile):
         """Delete a single file on remarkable <rfolder>/<rfile>"""
         rpath="{}/{}".format(rfolder, rfile)
-        self._run("rm", rpath)
+        async with self._writes:
+            await self._run("rm", rpath)
+        self._listings.pop(rfolder, None)
 
 
+@functools.lru_cache(maxsize=4096)
 def to_filename(text, nospaces=False):
     """Removes weird characters from a text to return a consistent name for file naming"""
     # add rules as we go
@@ -241,79 +321,168 @@ def to_filename(text, nospaces=False):
 
 
 # Main workflow
-def main():
+async def main():
+    # mendeley sdk is blocking, so its calls are handed off to the default executor
+    loop = asyncio.get_running_loop()
+
     # mendeley session
     session = get_session()
     
     # Find the remarkable folder in mendeley
-    folders = Folder.get_folders(session)
-    mfolder = next(filter(lambda f: f.name == REMARKABLE_FOLDER_IN_MENDELEY, folders), None)
-    if not mfolder:
-        print("Cannot find '{}' folder in mendeley. \nHere's the flattened list of folders: {}", 
-            REMARKABLE_FOLDER_IN_MENDELEY, ", ".join([f.name for f in folders]))
-        raise Exception("Cannot find remarkable folder in mendeley!")
-
-    # Get documents
-    mdocuments = mfolder.documents(session)
+    async with open_http(session) as http:
+        folders = await Folder.get_folders(session, http)
+        mfolder = next(filter(lambda f: f.name == REMARKABLE_FOLDER_IN_MENDELEY, folders), None)
+        if not mfolder:
+            print("Cannot find '{}' folder in mendeley. \nHere's the flattened list of folders: {}", 
+                REMARKABLE_FOLDER_IN_MENDELEY, ", ".join([f.name for f in folders]))
+            raise Exception("Cannot find remarkable folder in mendeley!")
+
+        # Get documents
+        mdocuments = await mfolder.documents(session, http)
+
     mfiles = {"{}---{}".format(to_filename(m.title), m.id) : idx  
                 for idx, m in enumerate(mdocuments)}      # all files names must be in this format
 
     # # See what files are present in the tablet
     rmapi = RmApi()
-    topfolders = rmapi.subfolders()
+    topfolders = await rmapi.subfolders()
     if MENDELEY_FOLDER_IN_REMARKABLE not in topfolders:
         print("Cannot find '{}' root-level folder in remarkable.".format(MENDELEY_FOLDER_IN_REMARKABLE))
         print("Create it if it does not exist, I won't.\nCurrent top-level folders: ", ", ".join(topfolders))
         raise Exception("Cannot find mendeley folder in remarkable!")
 
-    rfiles = rmapi.files(MENDELEY_FOLDER_IN_REMARKABLE)
+    rfiles = await rmapi.files(MENDELEY_FOLDER_IN_REMARKABLE)
     # print(rfiles)
     
     # Get the diff b/w mendeley and remarkable
-    m_and_r = [f for f in mfiles.keys() if f in rfiles]
-    m_minus_r = [f for f in mfiles.keys() if f not in rfiles]
-    r_minus_m = [f for f in rfiles if f not in mfiles.keys()]
+    mfiles_set, rfiles_set = mfiles.keys(), set(rfiles)
+    m_and_r = mfiles_set & rfiles_set
+    m_minus_r = mfiles_set - rfiles_set
+    r_minus_m = rfiles_set - mfiles_set
     # print(m_and_r, m_minus_r, r_minus_m)
 
-    # For documents in both, assume that remarkable has the updated file with annotations
-    # mendeley annotations are saved separately from the file itself so replacing the file 
-    # shouldn't affect the mendeley notes/comments.
-    for doc in m_and_r:
-        mdoc = mdocuments[mfiles[doc]]      
-        # download from remarkable with annotations
+    # Both mendeley passes below need the files attached to each document; listing 
+    # them is a request per document, so get them all up front and concurrently
+    def list_files(mdoc):
+        return list(mdoc.files.iter())
+    with ThreadPoolExecutor(MENDELEY_MAX_CONNECTIONS) as executor:
+        attached = await asyncio.gather(*(loop.run_in_executor(executor, list_files, m) 
+                                            for m in mdocuments))
+    files_by_doc = {m.id : files for m, files in zip(mdocuments, attached)}
+
+    async def pull(doc, outpath):
+        """Downloads a document from remarkable with annotations; returns False if it has none yet"""
         try:
-            localpath = "{}.pdf".format(uuid.uuid4().hex)
-            rmapi.download(MENDELEY_FOLDER_IN_REMARKABLE, doc, localpath)
+            await rmapi.download(MENDELEY_FOLDER_IN_REMARKABLE, doc, outpath)
+            return True
         except Exception as ex:
             # Skip if the error is about not having any annotations at all
             if "Failed to generate annotations" in str(ex):
-                print("Document skipped: {}. No annotations yet!".format(doc))
-                continue
+                return False
             raise
-        # NOTE: remove *all* currently attached files in mendeley
-        for file_ in mdoc.files.iter():
-            file_.delete()
-        mdoc.attach_file(localpath)
-        os.remove(localpath)
+
+    # Documents are independent of each other, so each of the passes below 
+    # syncs all of its documents concurrently. A document failing must not stop the 
+    # others halfway through (e.g., with attachments deleted but not yet re-attached), 
+    # so every document runs to completion and failures are reported after the pass.
+    failed = []
+    def record_failure(doc, ex):
+        print("Document failed: {}. {}".format(doc, ex))
+        failed.append(doc)
+
+    async def run_all(action, docs, *args):
+        docs = list(docs)
+        results = await asyncio.gather(*(action(doc, *args) for doc in docs), return_exceptions=True)
+        for doc, result in zip(docs, results):
+            if isinstance(result, Exception):
+                record_failure(doc, result)
+
+    def check_failures():
+        if failed:
+            raise Exception("Failed to sync documents: {}".format(", ".join(failed)))
+
+    # For documents in both, assume that remarkable has the updated file with annotations
+    # mendeley annotations are saved separately from the file itself so replacing the file 
+    # shouldn't affect the mendeley notes/comments.
+    async def sync_one(doc):
+        mdoc = mdocuments[mfiles[doc]]      
+        with tempfile.TemporaryDirectory() as td:
+            # download from remarkable with annotations
+            localpath = os.path.join(td, "{}.pdf".format(doc))
+            if not await pull(doc, localpath):
+                print("Document skipped: {}. No annotations yet!".format(doc))
+                return
+            # NOTE: remove *all* currently attached files in mendeley; 
+            # the deletes are independent so they can all go out together
+            await asyncio.gather(*(loop.run_in_executor(None, file_.delete) for file_ in files_by_doc[mdoc.id]))
+            await loop.run_in_executor(None, mdoc.attach_file, localpath)
         print("Document synced: {}".format(doc))
 
+    await run_all(sync_one, m_and_r)
+    check_failures()
+
     
     # For documents in mendeley that are not in remarkable: add them to remarkable
     # NOTE: we only consider first of the attached files for the document
-    for doc in m_minus_r:
+    # Downloads from mendeley and uploads to remarkable go to different places, so 
+    # they run as two stages connected by a bounded queue: documents get uploaded 
+    # as soon as they are downloaded, while the next few are downloading. A download 
+    # holds its slot until its file is queued, so at most PIPELINE_DEPTH documents are 
+    # being downloaded or waiting for the queue, and PIPELINE_DEPTH more sit in it.
+    # Each document is downloaded into its own subdir of a scratch dir, as attachments 
+    # of different documents may share a name; the subdir is removed as soon as the 
+    # document is uploaded (or fails), so only the documents in the pipeline are on disk.
+    PIPELINE_DEPTH = 4
+    uploads = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+    downloading = asyncio.Semaphore(PIPELINE_DEPTH)
+    async def download_one(doc, td):
+        async with downloading:
+            await fetch_one(doc, td)
+
+    async def fetch_one(doc, td):
         mdoc = mdocuments[mfiles[doc]]
-        path = None
-        for file_ in mdoc.files.iter():
-            path = file_.download(".")
-            break
-        if not path:
-            print("WARNING! no files attached for document: {}".format(mdoc.title))
-            continue
-        properpath = "{}.pdf".format(doc)       # name in remarkable, proper format
-        shutil.move(path, properpath)
-        rmapi.upload(properpath, MENDELEY_FOLDER_IN_REMARKABLE)
-        os.remove(properpath)
+        docdir = tempfile.mkdtemp(dir=td)
+        try:
+            path = None
+            for file_ in files_by_doc[mdoc.id]:
+                path = await loop.run_in_executor(None, file_.download, docdir)
+                break
+            if not path:
+                print("WARNING! no files attached for document: {}".format(mdoc.title))
+                shutil.rmtree(docdir, ignore_errors=True)
+                return
+            properpath = os.path.join(docdir, "{}.pdf".format(doc))       # name in remarkable, proper format
+            shutil.move(path, properpath)
+        except Exception:
+            shutil.rmtree(docdir, ignore_errors=True)
+            raise
+        await uploads.put((doc, properpath))
+
+    async def download_all(td):
+        await run_all(download_one, m_minus_r, td)
+        await uploads.put(None)         # tell the uploader there's nothing more
+
+    async def upload_one(doc, properpath):
+        try:
+            await rmapi.upload(properpath, MENDELEY_FOLDER_IN_REMARKABLE)
+        finally:
+            shutil.rmtree(os.path.dirname(properpath), ignore_errors=True)
         print("Document added: {}".format(doc))
+
+    # uploads change the remote folder, which rmapi only does one at a time anyway
+    async def upload_all():
+        while True:
+            item = await uploads.get()
+            if item is None:
+                break
+            try:
+                await upload_one(*item)
+            except Exception as ex:
+                record_failure(item[0], ex)
+
+    with tempfile.TemporaryDirectory() as td:
+        await asyncio.gather(download_all(td), upload_all())
+    check_failures()
         
 
     # For documents in remarkable that are not in mendeley: remove them from remarkable,
@@ -321,28 +490,24 @@ def main():
     # NOT previously synced will be lost.
     TRASHDIR = "trash"
     if not os.path.exists(TRASHDIR):   os.makedirs(TRASHDIR)
-    for doc in r_minus_m:
+    async def remove_one(doc):
         # before removing, try and download from remarkable if there are 
         # annotations and save it to trash, just in case
-        try:
-            localpath = "{}.pdf".format(doc)
-            trashpath = "{}/{}".format(TRASHDIR, localpath)
-            rmapi.download(MENDELEY_FOLDER_IN_REMARKABLE, doc, localpath)
-            shutil.move(localpath, trashpath)
-        except Exception as ex:
-            # Skip if the error is about not having any annotations at all
-            if "Failed to generate annotations" not in str(ex):
-                raise
+        await pull(doc, os.path.join(TRASHDIR, "{}.pdf".format(doc)))
         # delete it from remarkable
-        rmapi.remove(MENDELEY_FOLDER_IN_REMARKABLE, doc)
+        await rmapi.remove(MENDELEY_FOLDER_IN_REMARKABLE, doc)
         print("Document removed: {}".format(doc))
-    
-    # Remove any stray zip files
-    for item in os.listdir("."):    
-        if item.endswith(".zip"):   os.remove(item)
+
+    await run_all(remove_one, r_minus_m)
+    check_failures()
 
     print("Sync complete! Refresh your mendeley and remarkable apps.")
 
 
 if __name__=='__main__':
-    main()
+    # uvloop makes for a faster event loop but it is optional (and not available on windows)
+    try:
+        from uvloop import run
+    except ImportError:
+        from asyncio import run
+    run(main())